@@ -53,15 +53,18 @@ setup(
     ],
     install_requires=[
         # eg: "aspectlib==1.1.1", "six>=1.7",
-        'requests>=2.7.0'
+        # HTTPConnection._dns_host and the pool conn_kw/ca_cert_dir used by
+        # simplegcm.transport
+        'requests>=2.20.0',
+        'urllib3>=1.23',
     ],
     extras_require={
         # eg: 'rst': ["docutils>=0.11"],
     },
-    #entry_points={
-    #    "console_scripts": [
-    #        "simplegcm = simplegcm.__main__:main"
-    #    ]
-    #}
+    entry_points={
+        "console_scripts": [
+            "simplegcm = simplegcm.__main__:main"
+        ]
+    }
 
 )
@@ -0,0 +1,454 @@
+# -*- coding: utf-8 -*-
+
+"""
+simplegcm.__main__.
+
+This module implements the command line bulk sender.
+
+Example::
+
+    $ python -m simplegcm --api-key KEY --payload payload.json \\
+        --concurrency 8 --rate 50 --unregistered unregistered.txt \\
+        --canonicals canonicals.csv --failed failed.csv tokens.csv
+
+:copyright: (c) 2015 by Martin Alderete.
+:license: BSD License, see LICENSE for more details.
+
+"""
+
+import argparse
+import csv
+import io
+import json
+import os
+import sys
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from .gcm import Message
+from .gcm import Sender
+
+
+# GCM accepts up to 1000 registration_ids per request
+MAX_BATCH_SIZE = 1000
+MAX_BACKOFF = 60
+FORMATS = ('plain', 'csv', 'jsonl')
+PAYLOAD_KEYS = ('data', 'notification', 'options')
+PY2 = sys.version_info < (3,)
+
+
+def _native(value):
+    """Return value as the str the output files take, bytes on py2."""
+    if PY2 and isinstance(value, type(u'')):
+        return value.encode('utf-8')
+    return value
+
+
+def guess_format(path):
+    """Return the tokens format based on the file extension.
+
+    :rtype: str
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.csv':
+        return 'csv'
+    if ext in ('.jsonl', '.json'):
+        return 'jsonl'
+    return 'plain'
+
+
+def read_tokens(stream, fmt='plain', field=None):
+    """Yield the tokens read from the stream, one at a time.
+
+    :param stream: File like object.
+    :param fmt: One of 'plain', 'csv' or 'jsonl'.
+    :type fmt: str
+    :param field: CSV column name (the first column if not given) or
+        JSONL key ('token' if not given).
+    :type field: str
+    """
+    if fmt == 'csv':
+        if field:
+            rows = (row.get(field) for row in csv.DictReader(stream))
+        else:
+            rows = (row[0] if row else None for row in csv.reader(stream))
+    elif fmt == 'jsonl':
+        key = field or 'token'
+        rows = (json.loads(line).get(key) for line in stream if line.strip())
+    else:
+        rows = stream
+
+    for token in rows:
+        token = (token or '').strip()
+        if token:
+            yield token
+
+
+def describe_error(error):
+    """Return the message of an exception, decoding bytes arguments.
+
+    :rtype: str
+    """
+    args = [a.decode('utf-8', 'replace') if isinstance(a, bytes) else a
+            for a in error.args]
+    if not args:
+        return error.__class__.__name__
+    return u' '.join(u'%s' % a for a in args)
+
+
+def batches(tokens, size):
+    """Yield lists of up to size tokens.
+
+    :rtype: list
+    """
+    batch = []
+    for token in tokens:
+        batch.append(token)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class RateLimiter(object):
+    """Allow up to rate calls per second across threads.
+
+    :param rate: Calls per second, None or 0 for no limit.
+    :type rate: float
+    """
+
+    def __init__(self, rate=None):
+        self.interval = 1.0 / rate if rate else 0
+        self._lock = threading.Lock()
+        self._next = time.time()
+
+    def wait(self):
+        """Block until the next call is allowed."""
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.time()
+            slot = max(self._next, now)
+            self._next = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class Report(object):
+    """Write the results to the output files as they arrive.
+
+    :param unregistered: File for tokens not registered anymore.
+    :param canonicals: File for the "old,new" tokens pairs.
+    :param failed: File for the "token,error" pairs.
+    :param out: Stream where the progress is printed.
+    """
+
+    def __init__(self, unregistered=None, canonicals=None, failed=None, out=None):
+        self._lock = threading.Lock()
+        self._unregistered = unregistered
+        self._canonicals = csv.writer(canonicals) if canonicals else None
+        self._failed = csv.writer(failed) if failed else None
+        self._files = [f for f in (unregistered, canonicals, failed) if f]
+        self.out = out
+        self.start = time.time()
+        self.success = 0
+        self.canonical = 0
+        self.unregistered = 0
+        self.failed = 0
+
+    @property
+    def processed(self):
+        """Return the number of tokens with a final outcome.
+
+        :rtype: int
+        """
+        return self.success + self.unregistered + self.failed
+
+    def add_result(self, result):
+        """Record a :class:`~simplegcm.gcm.Result`, except its unavailables."""
+        with self._lock:
+            self.success += len(result.success)
+            self.canonical += len(result.canonicals or {})
+            self.unregistered += len(result.unregistered)
+            self.failed += len(result.failure)
+            if self._unregistered:
+                for token in result.unregistered:
+                    self._unregistered.write(_native(token + u'\n'))
+            if self._canonicals:
+                for old, new in (result.canonicals or {}).items():
+                    self._canonicals.writerow([_native(old), _native(new)])
+            if self._failed:
+                for token, error in result.failure.items():
+                    self._failed.writerow([_native(token), _native(error)])
+            self._flush()
+
+    def add_failed(self, tokens, error):
+        """Record tokens which could not be sent."""
+        with self._lock:
+            self.failed += len(tokens)
+            if self._failed:
+                for token in tokens:
+                    self._failed.writerow([_native(token), _native(error)])
+            self._flush()
+
+    def _flush(self):
+        for f in self._files:
+            f.flush()
+
+    def progress(self):
+        """Return a line describing the progress so far.
+
+        :rtype: str
+        """
+        elapsed = time.time() - self.start
+        rate = self.processed / elapsed if elapsed else 0.0
+        return ('%d tokens (%d ok, %d canonical, %d unregistered, %d failed) '
+                'in %.1fs, %.1f tokens/s' % (self.processed, self.success,
+                                            self.canonical, self.unregistered,
+                                            self.failed, elapsed, rate))
+
+    def print_progress(self):
+        if self.out is not None:
+            self.out.write(self.progress() + '\n')
+            self.out.flush()
+
+    def print_warmup(self, result):
+        """Print the problems found by :meth:`~simplegcm.gcm.Sender.warmup`."""
+        if self.out is None:
+            return
+        for error in result.errors:
+            self.out.write(_native(u'warm-up: connection failed: %s\n' % describe_error(error)))
+        for status in sorted(set(result.unexpected_statuses)):
+            self.out.write('warm-up: unexpected HTTP status %d, check the URL\n' % status)
+        self.out.flush()
+
+
+class BulkSender(object):
+    """Send a payload to a stream of tokens using a pool of threads.
+
+    Only a bounded number of batches is kept in memory, so the input
+    can be of any size.
+
+    :param sender: A :class:`~simplegcm.gcm.Sender`
+    :param payload: Message arguments other than the recipients.
+    :type payload: dict
+    :param report: A :class:`Report`
+    :param concurrency: Number of requests in flight.
+    :type concurrency: int
+    :param rate: Maximum requests per second.
+    :type rate: float
+    :param batch_size: Tokens per request.
+    :type batch_size: int
+    :param retries: Times the unavailable tokens are re-sent.
+    :type retries: int
+    :param progress_interval: Seconds between progress lines.
+    :type progress_interval: float
+    """
+
+    def __init__(self, sender, payload, report, concurrency=4, rate=None,
+                 batch_size=MAX_BATCH_SIZE, retries=2, progress_interval=1.0):
+        self.sender = sender
+        self.payload = payload
+        self.report = report
+        self.concurrency = concurrency
+        self.rate_limiter = RateLimiter(rate)
+        self.batch_size = batch_size
+        self.retries = retries
+        self.progress_interval = progress_interval
+        self._queue = queue.Queue(maxsize=concurrency * 2)
+        self._done = threading.Event()
+
+    def _backoff(self, result, attempt):
+        try:
+            backoff = int(result.backoff)
+        except (TypeError, ValueError):
+            backoff = 2 ** attempt
+        time.sleep(min(backoff, MAX_BACKOFF))
+
+    def _send(self, tokens):
+        message = Message(registration_ids=tokens, **self.payload)
+        for attempt in range(self.retries + 1):
+            self.rate_limiter.wait()
+            try:
+                result = self.sender.send(message)
+            except Exception as e:
+                self.report.add_failed(message._registration_ids, describe_error(e))
+                return
+            self.report.add_result(result)
+            retry_msg = result.get_retry_message()
+            if retry_msg is None:
+                return
+            message = retry_msg
+            if attempt < self.retries:
+                self._backoff(result, attempt)
+        self.report.add_failed(message._registration_ids, 'Unavailable')
+
+    def _work(self):
+        while True:
+            tokens = self._queue.get()
+            if tokens is None:
+                return
+            # A dead worker would leave the producer blocked on a full queue
+            try:
+                self._send(tokens)
+            except Exception as e:
+                self.report.add_failed(tokens, describe_error(e))
+
+    def _print_progress(self):
+        while not self._done.wait(self.progress_interval):
+            self.report.print_progress()
+
+    def run(self, tokens):
+        """Send the payload to every token.
+
+        :param tokens: Iterable of tokens.
+        :return: The report
+        :rtype: :class:`Report`
+        """
+        self.report.print_warmup(self.sender.warmup(self.concurrency))
+        workers = [threading.Thread(target=self._work)
+                   for _ in range(self.concurrency)]
+        progress = threading.Thread(target=self._print_progress)
+        progress.daemon = True
+        for thread in workers + [progress]:
+            thread.start()
+
+        try:
+            for batch in batches(tokens, self.batch_size):
+                self._queue.put(batch)
+        finally:
+            for _ in workers:
+                self._queue.put(None)
+            for worker in workers:
+                worker.join()
+            self._done.set()
+            progress.join()
+
+        self.report.print_progress()
+        return self.report
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog='python -m simplegcm',
+        description='Send a GCM message to every token of a file.',
+        epilog='The exit status is 1 when any token failed and 0 otherwise.')
+    parser.add_argument('tokens', nargs='?', default='-',
+                        help='Tokens file, "-" reads from stdin (default).')
+    parser.add_argument('-p', '--payload', required=True,
+                        help='JSON file with the "data", "notification" and "options" of the message.')
+    parser.add_argument('-k', '--api-key', default=os.environ.get('GCM_API_KEY'),
+                        help='Service\'s API key (default: $GCM_API_KEY).')
+    parser.add_argument('--url', help='Service\'s URL.')
+    parser.add_argument('-f', '--format', choices=FORMATS,
+                        help='Tokens format (default: guessed from the file extension).')
+    parser.add_argument('--field',
+                        help='CSV column or JSONL key with the token (default: first column / "token").')
+    parser.add_argument('-c', '--concurrency', type=int, default=4,
+                        help='Requests in flight (default: %(default)s).')
+    parser.add_argument('-r', '--rate', type=float,
+                        help='Maximum requests per second (default: no limit).')
+    parser.add_argument('-b', '--batch-size', type=int, default=MAX_BATCH_SIZE,
+                        help='Tokens per request (default: %(default)s).')
+    parser.add_argument('--retries', type=int, default=2,
+                        help='Times the unavailable tokens are re-sent (default: %(default)s).')
+    parser.add_argument('--unregistered', help='Output file for unregistered tokens.')
+    parser.add_argument('--canonicals', help='Output CSV file for "old,new" tokens.')
+    parser.add_argument('--failed', help='Output CSV file for "token,error" pairs.')
+    parser.add_argument('--record', help='Record the traffic to a trace file, see simplegcm.trace.')
+    parser.add_argument('--progress-interval', type=float, default=1.0,
+                        help='Seconds between progress lines (default: %(default)s).')
+    return parser
+
+
+def _open_output(path):
+    if path is None:
+        return None
+    if PY2:
+        # The py2 csv module only writes to binary files
+        return open(path, 'wb')
+    return io.open(path, 'w', encoding='utf-8', newline='')
+
+
+def main(argv=None):
+    """Run the command line bulk sender.
+
+    :param argv: Command line arguments (default: sys.argv[1:]).
+    :type argv: list
+    :return: Exit status, 1 if any token failed
+    :rtype: int
+    """
+    parser = build_parser()
+    args = parser.parse_args(argv)
+
+    if not args.api_key:
+        parser.error('an API key is required, use --api-key or $GCM_API_KEY')
+    if not 0 < args.batch_size <= MAX_BATCH_SIZE:
+        parser.error('--batch-size must be between 1 and %d' % MAX_BATCH_SIZE)
+    if args.concurrency < 1:
+        parser.error('--concurrency must be at least 1')
+    if args.retries < 0:
+        parser.error('--retries must be at least 0')
+    if args.rate is not None and args.rate <= 0:
+        parser.error('--rate must be greater than 0')
+
+    try:
+        with io.open(args.payload, encoding='utf-8') as f:
+            payload = json.load(f)
+    except (IOError, OSError) as e:
+        parser.error('can not read the payload: %s' % e)
+    except ValueError as e:
+        parser.error('invalid payload: %s' % e)
+    if not isinstance(payload, dict):
+        parser.error('the payload must be a JSON object')
+    unknown = set(payload) - set(PAYLOAD_KEYS)
+    if unknown:
+        parser.error('unknown payload keys: %s' % ', '.join(sorted(unknown)))
+    try:
+        Message(registration_ids=['validate'], **payload)
+    except (TypeError, ValueError) as e:
+        parser.error('invalid payload: %s' % e)
+
+    if args.tokens == '-':
+        tokens_file = sys.stdin
+        fmt = args.format or 'plain'
+    else:
+        try:
+            tokens_file = io.open(args.tokens, encoding='utf-8', newline='')
+        except (IOError, OSError) as e:
+            parser.error('can not read the tokens: %s' % e)
+        fmt = args.format or guess_format(args.tokens)
+
+    outputs = [_open_output(p) for p in (args.unregistered, args.canonicals, args.failed)]
+    recorder = None
+    if args.record:
+        from .trace import TraceRecorder
+        recorder = TraceRecorder(args.record)
+    try:
+        report = Report(*outputs, out=sys.stderr)
+        sender = Sender(api_key=args.api_key, url=args.url,
+                        pool_size=args.concurrency, recorder=recorder)
+        bulk = BulkSender(sender, payload, report,
+                          concurrency=args.concurrency, rate=args.rate,
+                          batch_size=args.batch_size, retries=args.retries,
+                          progress_interval=args.progress_interval)
+        report = bulk.run(read_tokens(tokens_file, fmt, args.field))
+    finally:
+        if tokens_file is not sys.stdin:
+            tokens_file.close()
+        for f in outputs:
+            if f is not None:
+                f.close()
+        if recorder is not None:
+            recorder.close()
+    return 1 if report.failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
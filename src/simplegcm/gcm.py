@@ -11,12 +11,19 @@ This module implements the Google Cloud Service API.
 """
 
 import json
-
-import requests
+import logging
+import threading
+import time
 
 
 __all__ = ('GCMException', 'Message', 'Notification',
-           'Result', 'Options', 'Sender')
+           'Result', 'Options', 'Sender', 'WarmupResult')
+
+logger = logging.getLogger(__name__)
+
+HTTP_OK = 200
+HTTP_BAD_REQUEST = 400
+HTTP_UNAUTHORIZED = 401
 
 
 class GCMException(Exception):
@@ -185,6 +192,48 @@ class Result(object):
         return None
 
 
+class WarmupResult(object):
+    """Outcome of :meth:`~simplegcm.gcm.Sender.warmup`.
+
+    :param timings: Seconds taken to open each connection.
+    :type timings: list
+    :param statuses: HTTP status answered on each connection.
+    :type statuses: list
+    :param errors: Exceptions raised by the connections which failed.
+    :type errors: list
+    :param elapsed: Seconds taken by the whole warm-up.
+    :type elapsed: float
+
+    """
+    # Answers to a HEAD on the send URL which show the service is there
+    EXPECTED_STATUSES = (405,)
+
+    def __init__(self, timings=None, statuses=None, errors=None, elapsed=None):
+        self.timings = timings or []
+        self.statuses = statuses or []
+        self.errors = errors or []
+        self.elapsed = elapsed
+
+    @property
+    def connections(self):
+        """Return the number of connections ready to be used.
+
+        :rtype: int
+        """
+        return len(self.timings)
+
+    @property
+    def unexpected_statuses(self):
+        """Return the statuses which are neither 2xx nor expected.
+
+        The connections are open anyway, but the URL may be wrong.
+
+        :rtype: list
+        """
+        return [s for s in self.statuses
+                if not 200 <= s < 300 and s not in self.EXPECTED_STATUSES]
+
+
 class Message(object):
     """GCM Message to send.
 
@@ -298,16 +347,50 @@ class Sender(object):
     :type api_key: str
     :param url: Service's URL
     :type url: str
+    :param pool_size: Maximum number of connections kept open.
+    :type pool_size: int
+    :param recorder: Records every request and response when given.
+    :type recorder: :class:`~simplegcm.trace.TraceRecorder`
 
     """
     GCM_URL = 'https://gcm-http.googleapis.com/gcm/send'
     result_class = Result
+    warmup_result_class = WarmupResult
+    # Defaults to :class:`~simplegcm.transport.GCMAdapter`, which is
+    # imported on the first send to keep the HTTP stack out of the
+    # package import.
+    adapter_class = None
 
-    def __init__(self, api_key=None, url=None):
+    def __init__(self, api_key=None, url=None, pool_size=10, recorder=None):
         self.api_key = api_key
         self.url = self.GCM_URL
         if url:
             self.url = url
+        self.pool_size = pool_size
+        self.recorder = recorder
+        self._session = None
+        self._session_lock = threading.Lock()
+
+    @property
+    def session(self):
+        """Return the HTTP session holding the connection pool.
+
+        :rtype: :class:`requests.Session`
+        """
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None:
+                    import requests
+                    from .transport import GCMAdapter
+
+                    adapter_class = self.adapter_class or GCMAdapter
+                    session = requests.Session()
+                    adapter = adapter_class(pool_connections=1,
+                                            pool_maxsize=self.pool_size)
+                    session.mount('https://', adapter)
+                    session.mount('http://', adapter)
+                    self._session = session
+        return self._session
 
     def _build_headers(self):
         headers = {
@@ -318,11 +401,11 @@ class Sender(object):
 
     def _parse_response(self, message, response):
         r_status = response.status_code
-        if r_status == requests.codes.BAD:
+        if r_status == HTTP_BAD_REQUEST:
             # bad request more info in content
             raise GCMException(response.content)
 
-        if r_status == requests.codes.UNAUTHORIZED:
+        if r_status == HTTP_UNAUTHORIZED:
             # Invalid API key
             raise GCMException('Unauthorized API_KEY')
 
@@ -342,7 +425,7 @@ class Sender(object):
                 'unavailables': message._registration_ids,
                 'backoff': retry_after
             }
-        elif r_status == requests.codes.OK:
+        elif r_status == HTTP_OK:
             r_ids = message._registration_ids
             resp_data = response.json()
 
@@ -387,15 +470,73 @@ class Sender(object):
         headers = self._build_headers()
         data = json.dumps(payload)
 
-        response = requests.post(self.url, data, headers=headers)
+        start = time.time()
+        response = self.session.post(self.url, data, headers=headers)
+        if self.recorder is not None:
+            self._record(message, data, response, time.time() - start)
         result_data = self._parse_response(message, response)
         gcm_result = self.result_class(**result_data)
         return gcm_result
 
+    def _record(self, message, data, response, latency):
+        # Recording is a side channel, it must never change what send returns
+        tokens = len(message._registration_ids) if message._registration_ids else 1
+        try:
+            self.recorder.record(len(data), tokens, response, latency)
+        except Exception:
+            logger.exception('Could not record the request')
+
     def _build_payload(self, message):
         payload = message.body
         return payload
 
+    def _open_connection(self, responses, errors):
+        start = time.time()
+        try:
+            # Keep the response unread so its connection stays busy and
+            # every worker is forced to open a connection of its own.
+            response = self.session.head(self.url, headers=self._build_headers(),
+                                         stream=True)
+        except Exception as e:
+            errors.append(e)
+        else:
+            responses.append((time.time() - start, response))
+
+    def warmup(self, n=1):
+        """Open connections to the service in parallel.
+
+        Each connection resolves the host, completes the TLS handshake and
+        makes a HEAD request up-front, so the first calls to :meth:`send`
+        do not pay for them. The status of each HEAD is recorded in the
+        result, see :attr:`~simplegcm.gcm.WarmupResult.unexpected_statuses`.
+
+        :param n: Number of connections to open.
+        :type n: int
+        :return: Warm-up timings
+        :rtype: :class:`~simplegcm.gcm.WarmupResult`
+        :raises ValueError: If n is bigger than the pool size.
+        """
+        if n > self.pool_size:
+            raise ValueError('Can not warm up more connections than the pool size!')
+
+        errors = []
+        responses = []
+        start = time.time()
+        workers = [threading.Thread(target=self._open_connection,
+                                    args=(responses, errors))
+                   for _ in range(n)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        # Reading the (empty) bodies gives the connections back to the pool.
+        for _, response in responses:
+            response.content
+        elapsed = time.time() - start
+        return self.warmup_result_class(timings=[t for t, _ in responses],
+                                        statuses=[r.status_code for _, r in responses],
+                                        errors=errors, elapsed=elapsed)
+
     def send(self, message):
         """Send a message.
 
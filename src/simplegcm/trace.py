@@ -0,0 +1,384 @@
+# -*- coding: utf-8 -*-
+
+"""
+simplegcm.trace.
+
+This module implements the traffic recording and replay.
+
+A trace is a JSON lines file (gzipped if its name ends with ``.gz``) with
+one record per request sent to GCM::
+
+    {"t": 0.0, "size": 120, "tokens": 3, "status": 200, "latency": 0.08,
+     "retry_after": null, "body": "{\\"multicast_id\\": 1, ...}"}
+
+Record a production session::
+
+    >>> from simplegcm.trace import TraceRecorder
+    >>> recorder = TraceRecorder('session.jsonl.gz')
+    >>> sender = simplegcm.Sender(api_key='your_api_key', recorder=recorder)
+
+Replay it against the current build and compare with a previous run::
+
+    $ python -m simplegcm.trace replay session.jsonl.gz --output new.json
+    $ python -m simplegcm.trace compare old.json new.json
+
+Requests which failed before getting a response are not recorded.
+
+:copyright: (c) 2015 by Martin Alderete.
+:license: BSD License, see LICENSE for more details.
+
+"""
+
+import argparse
+import gzip
+import io
+import json
+import sys
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+if sys.version_info < (3,):
+    import BaseHTTPServer
+    import SocketServer as socketserver
+else:
+    import socketserver
+    from http import server as BaseHTTPServer
+
+from .gcm import Message
+from .gcm import Sender
+
+
+__all__ = ('TraceRecorder', 'read_trace', 'ReplayServer', 'replay',
+           'summarize', 'compare')
+
+
+def _open(path, mode):
+    if not path.endswith('.gz'):
+        return io.open(path, mode, encoding='utf-8')
+    if sys.version_info < (3,):
+        # py2 GzipFile lacks read1, which TextIOWrapper needs
+        buffered = io.BufferedReader if mode == 'r' else io.BufferedWriter
+        return io.TextIOWrapper(buffered(gzip.open(path, mode + 'b')), encoding='utf-8')
+    return gzip.open(path, mode + 't', encoding='utf-8')
+
+
+class TraceRecorder(object):
+    """Write the requests made by a :class:`~simplegcm.gcm.Sender` to a trace.
+
+    :param path: Trace file, gzipped if it ends with ``.gz``.
+    :type path: str
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = _open(path, 'w')
+        self._lock = threading.Lock()
+        self._start = time.time()
+
+    def record(self, size, tokens, response, latency):
+        """Record a request and its response.
+
+        :param size: Payload size in bytes.
+        :type size: int
+        :param tokens: Number of tokens in the message.
+        :type tokens: int
+        :param response: HTTP response.
+        :type response: :class:`requests.Response`
+        :param latency: Seconds taken by the request.
+        :type latency: float
+        """
+        start = time.time() - latency
+        record = {
+            'size': size,
+            'tokens': tokens,
+            'status': response.status_code,
+            'latency': round(latency, 6),
+            'retry_after': response.headers.get('Retry-After'),
+            'body': response.text,
+            # Request start, relative to the recorder creation
+            't': round(start - self._start, 6),
+        }
+        with self._lock:
+            # json.dumps returns a byte str on py2, the ASCII output is
+            # safe to format into the unicode the text file takes.
+            line = json.dumps(record, separators=(',', ':'), sort_keys=True, ensure_ascii=True)
+            self._file.write(u'%s\n' % line)
+
+    def close(self):
+        """Flush and close the trace file."""
+        with self._lock:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def read_trace(path):
+    """Yield the records of a trace, one at a time.
+
+    The records come in the order the requests completed, which is not
+    the order they were sent when they overlap.
+
+    :param path: Trace file.
+    :type path: str
+    :rtype: dict
+    """
+    with _open(path, 'r') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def _percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, int(len(values) * p / 100.0))
+    return values[index]
+
+
+def summarize(records, elapsed=None):
+    """Return the throughput and latency of a list of records.
+
+    :param records: Records with at least "tokens" and "latency".
+    :type records: list
+    :param elapsed: Seconds taken by the session, from the first request
+        start to the last request end of the records if not given.
+    :type elapsed: float
+    :rtype: dict
+    """
+    if elapsed is None and records:
+        elapsed = (max(r['t'] + r['latency'] for r in records) -
+                   min(r['t'] for r in records))
+    tokens = sum(r['tokens'] for r in records)
+    latencies = [r['latency'] for r in records]
+    summary = {
+        'requests': len(records),
+        'tokens': tokens,
+        'elapsed': elapsed,
+        'requests_per_second': len(records) / elapsed if elapsed else None,
+        'tokens_per_second': tokens / elapsed if elapsed else None,
+    }
+    for p in (50, 90, 99):
+        summary['latency_p%d' % p] = _percentile(latencies, p)
+    return summary
+
+
+class ReplayHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answer each request with the recorded response it replays."""
+
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written apart, Nagle would delay the body
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length).decode('utf-8'))
+        record = self.server.records[body['data']['replay']]
+        time.sleep(record['latency'] * self.server.latency_scale)
+
+        data = record['body'].encode('utf-8')
+        self.send_response(record['status'])
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        if record.get('retry_after') is not None:
+            self.send_header('Retry-After', record['retry_after'])
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class ReplayServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Local mock GCM server which replays the records of a trace.
+
+    :param records: Trace records.
+    :type records: list
+    :param address: Address to listen on, a random port by default.
+    :type address: tuple
+    :param latency_scale: Factor applied to the recorded latencies.
+    :type latency_scale: float
+    """
+
+    daemon_threads = True
+
+    def __init__(self, records, address=('127.0.0.1', 0), latency_scale=1.0):
+        BaseHTTPServer.HTTPServer.__init__(self, address, ReplayHandler)
+        self.records = records
+        self.latency_scale = latency_scale
+
+    @property
+    def url(self):
+        return 'http://%s:%d/gcm/send' % self.server_address[:2]
+
+
+def _build_message(index, record):
+    """Return a message with the record's token count and payload size."""
+    tokens = ['replay%d' % i for i in range(record['tokens'])]
+    data = {'replay': index, 'padding': ''}
+    message = Message(registration_ids=tokens, data=data)
+    padding = record['size'] - len(json.dumps(message.body))
+    data['padding'] = 'x' * max(0, padding)
+    return message
+
+
+def replay(records, concurrency=4, speed=1.0, latency_scale=1.0, sender_class=Sender):
+    """Replay the records against a local :class:`ReplayServer`.
+
+    :param records: Trace records.
+    :type records: list
+    :param concurrency: Requests in flight.
+    :type concurrency: int
+    :param speed: Factor applied to the recorded request times, 0 sends
+        the requests as fast as possible.
+    :type speed: float
+    :param latency_scale: Factor applied to the recorded latencies.
+    :type latency_scale: float
+    :param sender_class: Sender to exercise.
+    :return: Summary of the replayed session, see :func:`summarize`
+    :rtype: dict
+    """
+    # Send the requests in the order they were sent, not completed
+    records = sorted(records, key=lambda r: r['t'])
+    first = records[0]['t'] if records else 0
+    server = ReplayServer(records, latency_scale=latency_scale)
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+
+    sender = sender_class(api_key='replay', url=server.url, pool_size=concurrency)
+    sender.warmup(concurrency)
+    pending = queue.Queue(maxsize=concurrency * 2)
+    results = []
+    lock = threading.Lock()
+
+    def work():
+        while True:
+            item = pending.get()
+            if item is None:
+                return
+            index, record = item
+            message = _build_message(index, record)
+            error = None
+            start = time.time()
+            try:
+                sender.send(message)
+            except Exception as e:
+                error = e.__class__.__name__
+            latency = time.time() - start
+            with lock:
+                results.append({'tokens': record['tokens'], 'latency': latency,
+                                'error': error})
+
+    workers = [threading.Thread(target=work) for _ in range(concurrency)]
+    for worker in workers:
+        worker.start()
+    start = time.time()
+    try:
+        for index, record in enumerate(records):
+            if speed:
+                delay = start + (record['t'] - first) / speed - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            pending.put((index, record))
+    finally:
+        for _ in workers:
+            pending.put(None)
+        for worker in workers:
+            worker.join()
+        elapsed = time.time() - start
+        server.shutdown()
+        server.server_close()
+    summary = summarize(results, elapsed)
+    summary['errors'] = sum(1 for r in results if r['error'])
+    return summary
+
+
+def compare(base, new):
+    """Return the relative change of each metric between two summaries.
+
+    :rtype: dict
+    """
+    changes = {}
+    for key, value in base.items():
+        other = new.get(key)
+        if isinstance(value, (int, float)) and isinstance(other, (int, float)) and value:
+            changes[key] = (other - value) / float(value)
+    return changes
+
+
+def _print_table(out, headers, summaries, changes=None):
+    out.write('%-22s' % 'metric' + ''.join('%14s' % h for h in headers) + '\n')
+    for key in sorted(set().union(*summaries)):
+        row = '%-22s' % key
+        for summary in summaries:
+            value = summary.get(key)
+            row += '%14s' % ('-' if value is None else '%.4g' % value)
+        if changes is not None and key in changes:
+            row += '%+13.1f%%' % (changes[key] * 100)
+        out.write(row + '\n')
+
+
+def main(argv=None):
+    """Run the replay command line tool.
+
+    :param argv: Command line arguments (default: sys.argv[1:]).
+    :type argv: list
+    :return: Exit status
+    :rtype: int
+    """
+    parser = argparse.ArgumentParser(prog='python -m simplegcm.trace',
+                                     description='Replay recorded GCM traffic.')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    cmd = commands.add_parser('replay', help='Replay a trace against a local mock server.')
+    cmd.add_argument('trace', help='Trace file.')
+    cmd.add_argument('-c', '--concurrency', type=int, default=4,
+                     help='Requests in flight (default: %(default)s).')
+    cmd.add_argument('-s', '--speed', type=float, default=1.0,
+                     help='Speed factor, 0 sends as fast as possible (default: %(default)s).')
+    cmd.add_argument('--latency-scale', type=float, default=1.0,
+                     help='Factor applied to the recorded latencies (default: %(default)s).')
+    cmd.add_argument('-o', '--output', help='Save the summary as JSON.')
+
+    cmd = commands.add_parser('compare', help='Compare two saved summaries.')
+    cmd.add_argument('base', help='Summary of the reference build.')
+    cmd.add_argument('new', help='Summary of the new build.')
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'replay':
+        records = list(read_trace(args.trace))
+        summary = replay(records, concurrency=args.concurrency, speed=args.speed,
+                         latency_scale=args.latency_scale)
+        _print_table(sys.stdout, ('recorded', 'replayed'), [summarize(records), summary])
+        if args.output:
+            with io.open(args.output, 'w', encoding='utf-8') as f:
+                # Byte str on py2, ASCII so it formats into unicode
+                f.write(u'%s' % json.dumps(summary, indent=2, sort_keys=True))
+    else:
+        summaries = []
+        for path in (args.base, args.new):
+            with io.open(path, encoding='utf-8') as f:
+                summaries.append(json.load(f))
+        _print_table(sys.stdout, ('base', 'new'), summaries, compare(*summaries))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+
+"""
+simplegcm.transport.
+
+This module implements the HTTP transport used by the Sender.
+
+:copyright: (c) 2015 by Martin Alderete.
+:license: BSD License, see LICENSE for more details.
+
+"""
+
+import socket
+import ssl
+import threading
+import time
+
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+from urllib3.connection import HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool
+from urllib3.connectionpool import HTTPSConnectionPool
+
+
+__all__ = ('DNSCache', 'GCMAdapter')
+
+
+class DNSCache(object):
+    """Thread safe cache of resolved addresses.
+
+    :param ttl: Seconds a resolved address is kept.
+    :type ttl: int
+    """
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._addresses = {}
+
+    def resolve(self, host, port):
+        """Return the addresses for host, resolving it only on a cache miss.
+
+        The host is returned unchanged if it can not be resolved so the
+        caller reports the error as usual.
+
+        :rtype: list
+        """
+        key = (host, port)
+        now = time.time()
+        with self._lock:
+            entry = self._addresses.get(key)
+        if entry is not None and entry[1] > now:
+            return entry[0]
+
+        try:
+            infos = socket.getaddrinfo(host.strip('[]'), port, 0, socket.SOCK_STREAM)
+        except socket.error:
+            return [host]
+
+        addresses = []
+        for info in infos:
+            if info[4][0] not in addresses:
+                addresses.append(info[4][0])
+        with self._lock:
+            self._addresses[key] = (addresses, now + self.ttl)
+        return addresses
+
+    def evict(self, host, port):
+        """Forget the addresses of host, they are resolved again on next use."""
+        with self._lock:
+            self._addresses.pop((host, port), None)
+
+    def clear(self):
+        """Forget all the resolved addresses."""
+        with self._lock:
+            self._addresses.clear()
+
+
+dns_cache = DNSCache()
+
+
+class _CachedDNSMixin(object):
+    """Connect to the addresses cached in :data:`dns_cache`.
+
+    Each address is tried in order, as urllib3 does with the resolved
+    addresses, and the entry is evicted when one of them fails so it
+    is resolved again on the next connection.
+
+    Only the address used to open the socket is replaced, the original
+    host is still used for the Host header and the TLS server name.
+    """
+
+    def _new_conn(self):
+        dns_host = self._dns_host
+        addresses = dns_cache.resolve(dns_host, self.port)
+        try:
+            for i, address in enumerate(addresses):
+                self._dns_host = address
+                try:
+                    return super(_CachedDNSMixin, self)._new_conn()
+                except Exception:
+                    dns_cache.evict(dns_host, self.port)
+                    if i == len(addresses) - 1:
+                        raise
+        finally:
+            self._dns_host = dns_host
+
+
+class CachedDNSHTTPConnection(_CachedDNSMixin, HTTPConnection):
+    pass
+
+
+class CachedDNSHTTPSConnection(_CachedDNSMixin, HTTPSConnection):
+    pass
+
+
+class CachedDNSHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = CachedDNSHTTPConnection
+
+
+class CachedDNSHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = CachedDNSHTTPSConnection
+
+
+if hasattr(ssl.SSLContext, 'sslsocket_class'):
+    class _ResumableSSLSocket(ssl.SSLSocket):
+        """SSL socket which hands its TLS session back to the context on close."""
+
+        def close(self):
+            if isinstance(self.context, ResumableSSLContext):
+                self.context.remember(self)
+            super(_ResumableSSLSocket, self).close()
+
+    class ResumableSSLContext(ssl.SSLContext):
+        """SSL context which resumes TLS sessions on reconnects.
+
+        The last session seen for each server name is offered on the next
+        handshake against the same server, saving a full handshake.
+        """
+
+        sslsocket_class = _ResumableSSLSocket
+
+        def __new__(cls, protocol=ssl.PROTOCOL_TLS_CLIENT, *args, **kwargs):
+            self = super(ResumableSSLContext, cls).__new__(cls, protocol, *args, **kwargs)
+            self._sessions_lock = threading.Lock()
+            self._sessions = {}
+            return self
+
+        def remember(self, sock):
+            """Store the TLS session of the given socket."""
+            try:
+                session = sock.session
+            except (AttributeError, ValueError):
+                return
+            if session is not None and sock.server_hostname:
+                with self._sessions_lock:
+                    self._sessions[sock.server_hostname] = session
+
+        def wrap_socket(self, sock, *args, **kwargs):
+            hostname = kwargs.get('server_hostname')
+            if hostname and kwargs.get('session') is None:
+                with self._sessions_lock:
+                    kwargs['session'] = self._sessions.get(hostname)
+            return super(ResumableSSLContext, self).wrap_socket(sock, *args, **kwargs)
+
+        @classmethod
+        def create(cls, ca_certs=None, ca_cert_dir=None):
+            """Return a context with the usual client defaults.
+
+            :param ca_certs: CA bundle file, loaded once here.
+            :type ca_certs: str
+            :param ca_cert_dir: CA certificates directory.
+            :type ca_cert_dir: str
+            """
+            context = cls(ssl.PROTOCOL_TLS_CLIENT)
+            context.minimum_version = ssl.TLSVersion.TLSv1_2
+            if ca_certs or ca_cert_dir:
+                context.load_verify_locations(ca_certs, ca_cert_dir)
+            else:
+                context.load_default_certs()
+            return context
+else:
+    ResumableSSLContext = None
+
+
+class GCMAdapter(HTTPAdapter):
+    """Transport adapter with DNS caching and TLS session resumption.
+
+    Verified HTTPS connections share a :class:`ResumableSSLContext` per
+    CA bundle, so the bundle is loaded once instead of on every new
+    connection. Unverified or client certificate connections use the
+    usual urllib3 context.
+
+    Receives the same arguments as :class:`requests.adapters.HTTPAdapter`.
+    """
+
+    def init_poolmanager(self, connections, maxsize, block=False, **pool_kwargs):
+        self._ssl_contexts_lock = threading.Lock()
+        self._ssl_contexts = {}
+        super(GCMAdapter, self).init_poolmanager(connections, maxsize,
+                                                 block=block, **pool_kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': CachedDNSHTTPConnectionPool,
+            'https': CachedDNSHTTPSConnectionPool,
+        }
+
+    def _ssl_context(self, ca_certs, ca_cert_dir):
+        key = (ca_certs, ca_cert_dir)
+        with self._ssl_contexts_lock:
+            if key not in self._ssl_contexts:
+                self._ssl_contexts[key] = ResumableSSLContext.create(ca_certs, ca_cert_dir)
+            return self._ssl_contexts[key]
+
+    def cert_verify(self, conn, url, verify, cert):
+        super(GCMAdapter, self).cert_verify(conn, url, verify, cert)
+        if ResumableSSLContext is None or not isinstance(conn, HTTPSConnectionPool):
+            return
+
+        if conn.cert_reqs == 'CERT_REQUIRED' and not conn.cert_file:
+            context = self._ssl_context(conn.ca_certs, conn.ca_cert_dir)
+            # The context already holds the CA bundle, do not let urllib3
+            # load it again for each connection.
+            conn.ca_certs = None
+            conn.ca_cert_dir = None
+            conn.conn_kw['ssl_context'] = context
+        else:
+            conn.conn_kw.pop('ssl_context', None)
@@ -2,18 +2,35 @@
 import sys
 if sys.version_info < (3,):
     import BaseHTTPServer
+    import SocketServer as socketserver
     b = lambda x: x
 else:
     import codecs
+    import socketserver
     from http import server as BaseHTTPServer
     b = lambda x: codecs.latin_1_encode(x)[0]
 
 # Regular imports
+import io
 import json
+import logging
+import os
+import shutil
+import ssl
+import subprocess
+import tempfile
 import threading
+import time
 import unittest
 
+import simplegcm
 from simplegcm import Sender, Message, GCMException
+from simplegcm.__main__ import main, read_tokens
+from simplegcm import trace
+
+CERT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'localhost.pem')
+# Microseconds allowed to "import simplegcm", requests alone takes ~100ms
+IMPORT_TIME_BUDGET = 50000
 
 
 class MockGCMHandler(BaseHTTPServer.BaseHTTPRequestHandler):
@@ -78,9 +95,34 @@ class MockGCMHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         }
     }
 
+    def _echo_response(self):
+        """Answer each token according to its prefix."""
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length).decode('utf-8'))
+        results = []
+        for i, token in enumerate(body['registration_ids']):
+            if token.startswith('old'):
+                results.append({'message_id': i, 'registration_id': 'new' + token[3:]})
+            elif token.startswith('unreg'):
+                results.append({'error': 'NotRegistered'})
+            elif token.startswith('unavail'):
+                results.append({'error': 'Unavailable'})
+            elif token.startswith('bad'):
+                results.append({'error': 'InvalidRegistration'})
+            else:
+                results.append({'message_id': i})
+        return {
+            'status': 200,
+            'headers': {'Content-Type': 'application/json'},
+            'response': {'multicast_id': 1, 'results': results}
+        }
+
     def _dispatch(self):
         key = self.path
-        test_data = self.TEST_CASES_DATA[key]
+        if key == '/echo/':
+            test_data = self._echo_response()
+        else:
+            test_data = self.TEST_CASES_DATA[key]
 
         self.send_response(test_data['status'])
         for k, v in test_data.get('headers', {}).items():
@@ -96,8 +138,15 @@ class MockGCMHandler(BaseHTTPServer.BaseHTTPRequestHandler):
 class MockGCMServer(threading.Thread):
     """Mock server which run in a separated thread."""
 
+    def start(self):
+        threading.Thread.start(self)
+        # Wait until the server is listening
+        while not hasattr(self, 'httpd'):
+            time.sleep(0.01)
+
     def shutdown(self):
         self.httpd.shutdown()
+        self.httpd.server_close()
 
     def run(self):
         hand = MockGCMHandler
@@ -106,6 +155,64 @@ class MockGCMServer(threading.Thread):
         self.httpd.serve_forever()
 
 
+class KeepAliveGCMHandler(MockGCMHandler):
+    """Mock HTTP handler which keeps the connections open."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def _dispatch(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        self.rfile.read(length)
+        test_data = self.TEST_CASES_DATA[self.path]
+        data = b(json.dumps(test_data['response']))
+
+        self.send_response(test_data['status'])
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class TLSHTTPServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """TLS server which simulates a slow network on every handshake."""
+
+    daemon_threads = True
+    handshake_delay = 0.1
+
+    def __init__(self, *args, **kwargs):
+        BaseHTTPServer.HTTPServer.__init__(self, *args, **kwargs)
+        self.context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        self.context.load_cert_chain(CERT_FILE)
+        self.handshakes = 0
+        self.resumed = 0
+
+    def finish_request(self, request, client_address):
+        time.sleep(self.handshake_delay)
+        request = self.context.wrap_socket(request, server_side=True)
+        self.handshakes += 1
+        if request.session_reused:
+            self.resumed += 1
+        try:
+            BaseHTTPServer.HTTPServer.finish_request(self, request, client_address)
+        finally:
+            request.close()
+
+
+class MockTLSGCMServer(MockGCMServer):
+    """Mock TLS server which run in a separated thread."""
+
+    def run(self):
+        self.httpd = TLSHTTPServer(('localhost', 9001), KeepAliveGCMHandler)
+        self.httpd.serve_forever()
+
+
 class MainTestCase(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
@@ -116,6 +223,13 @@ class MainTestCase(unittest.TestCase):
     def tearDownClass(cls):
         cls.httpd.shutdown()
 
+    def test_warmup_statuses(self):
+        # The mock server does not know about HEAD
+        g = Sender(api_key='fake', url='http://localhost:9000/200/')
+        ret = g.warmup(1)
+        self.assertEqual(ret.connections, 1)
+        self.assertEqual(ret.unexpected_statuses, [501])
+
     def test_build_bad_messages(self):
         d = {'score': 5.0}
         ids = ['ABC123']
@@ -208,5 +322,383 @@ class MainTestCase(unittest.TestCase):
         self.assertNotEqual(id(m), id(retry_msg))
 
 
+@unittest.skipIf(sys.version_info < (3, 7), 'requires TLS session resumption support')
+class WarmupTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.httpd = MockTLSGCMServer()
+        cls.httpd.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.httpd.shutdown()
+
+    def _sender(self):
+        g = Sender(api_key='fake', url='https://localhost:9001/200/', pool_size=4)
+        g.session.trust_env = False
+        g.session.verify = CERT_FILE
+        return g
+
+    def _timed_send(self, g):
+        m = Message(registration_ids=['ABC123'], data={'score': 5.0})
+        start = time.time()
+        r = g.send(m)
+        self.assertEqual(len(r.success), 1)
+        return time.time() - start
+
+    def test_warmup(self):
+        server = self.httpd.httpd
+        cold = self._timed_send(self._sender())
+
+        g = self._sender()
+        handshakes = server.handshakes
+        ret = g.warmup(4)
+        self.assertEqual(ret.connections, 4)
+        self.assertEqual(ret.errors, [])
+        self.assertEqual(len(ret.timings), 4)
+        self.assertEqual(ret.statuses, [200] * 4)
+        self.assertEqual(ret.unexpected_statuses, [])
+        self.assertEqual(server.handshakes - handshakes, 4)
+        # The handshakes are done in parallel
+        self.assertLess(ret.elapsed, 4 * server.handshake_delay)
+
+        warm = self._timed_send(g)
+        self.assertEqual(server.handshakes - handshakes, 4)
+        self.assertLess(warm, server.handshake_delay)
+        self.assertLess(warm, cold)
+
+    def test_warmup_errors(self):
+        g = self._sender()
+        self.assertRaises(ValueError, lambda: g.warmup(5))
+        g.url = 'https://localhost:1111'  # invalid
+        ret = g.warmup(2)
+        self.assertEqual(ret.connections, 0)
+        self.assertEqual(len(ret.errors), 2)
+
+    def test_verify_disabled(self):
+        g = self._sender()
+        g.session.verify = False
+        self._timed_send(g)
+
+    def test_ca_bundle_loaded_once(self):
+        from simplegcm.transport import ResumableSSLContext
+        calls = []
+        load_verify_locations = ResumableSSLContext.load_verify_locations
+
+        def counting(context, *args, **kwargs):
+            calls.append(args)
+            return load_verify_locations(context, *args, **kwargs)
+
+        ResumableSSLContext.load_verify_locations = counting
+        try:
+            g = self._sender()
+            self.assertEqual(g.warmup(4).connections, 4)
+            self._timed_send(g)
+            g.session.close()
+            self._timed_send(g)
+        finally:
+            del ResumableSSLContext.load_verify_locations
+        self.assertEqual(len(calls), 1)
+
+    def test_dns_fallback(self):
+        from simplegcm.transport import dns_cache
+        key = ('localhost', 9001)
+        # Nothing listens on the first address
+        dns_cache._addresses[key] = (['127.0.0.2', '127.0.0.1'], time.time() + 60)
+        try:
+            self._timed_send(self._sender())
+            self.assertNotIn(key, dns_cache._addresses)
+            self._timed_send(self._sender())
+            self.assertIn(key, dns_cache._addresses)
+        finally:
+            dns_cache.evict(*key)
+
+    def test_tls_session_resumption(self):
+        server = self.httpd.httpd
+        g = self._sender()
+        self._timed_send(g)
+        # Drop the pooled connections to force a reconnect
+        g.session.close()
+        resumed = server.resumed
+        self._timed_send(g)
+        self.assertEqual(server.resumed - resumed, 1)
+
+
+class CommandLineTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.httpd = MockGCMServer()
+        cls.httpd.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.httpd.shutdown()
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.payload = self._path('payload.json')
+        with io.open(self.payload, 'w', encoding='utf-8') as f:
+            f.write(u'{"data": {"score": 5.0}, "options": {"dry_run": true}}')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def _path(self, name):
+        return os.path.join(self.tmp, name)
+
+    def _write(self, name, content):
+        with io.open(self._path(name), 'w', encoding='utf-8') as f:
+            f.write(content)
+        return self._path(name)
+
+    def _read(self, name):
+        with io.open(self._path(name), encoding='utf-8') as f:
+            return f.read().splitlines()
+
+    def test_read_tokens(self):
+        plain = io.StringIO(u'ABC\n\n DEF \n')
+        self.assertEqual(list(read_tokens(plain)), ['ABC', 'DEF'])
+        rows = io.StringIO(u'ABC,1\nDEF,2\n')
+        self.assertEqual(list(read_tokens(rows, 'csv')), ['ABC', 'DEF'])
+        rows = io.StringIO(u'id,token\n1,ABC\n2,DEF\n')
+        self.assertEqual(list(read_tokens(rows, 'csv', 'token')), ['ABC', 'DEF'])
+        lines = io.StringIO(u'{"token": "ABC"}\n\n{"token": "DEF"}\n')
+        self.assertEqual(list(read_tokens(lines, 'jsonl')), ['ABC', 'DEF'])
+
+    def test_bulk_send(self):
+        tokens = ['tok%d' % i for i in range(10)] + ['oldABC', 'unregABC', 'badABC', 'unavailABC']
+        path = self._write('tokens.jsonl', u''.join(u'{"token": "%s"}\n' % t for t in tokens))
+        ret = main([path, '--payload', self.payload, '--api-key', 'fake',
+                    '--url', 'http://localhost:9000/echo/',
+                    '--concurrency', '2', '--batch-size', '3', '--retries', '0',
+                    '--unregistered', self._path('unreg.txt'),
+                    '--canonicals', self._path('canonicals.csv'),
+                    '--failed', self._path('failed.csv')])
+        self.assertEqual(ret, 1)
+        self.assertEqual(self._read('unreg.txt'), ['unregABC'])
+        self.assertEqual(self._read('canonicals.csv'), ['oldABC,newABC'])
+        self.assertEqual(sorted(self._read('failed.csv')),
+                         ['badABC,InvalidRegistration', 'unavailABC,Unavailable'])
+
+    def test_bulk_send_errors(self):
+        path = self._write('tokens.txt', u'ABC\nDEF\n')
+        ret = main([path, '--payload', self.payload, '--api-key', 'fake',
+                    '--url', 'http://localhost:9000/401/', '--failed', self._path('failed.csv')])
+        self.assertEqual(ret, 1)
+        self.assertEqual(sorted(self._read('failed.csv')),
+                         ['ABC,Unauthorized API_KEY', 'DEF,Unauthorized API_KEY'])
+        main([path, '--payload', self.payload, '--api-key', 'fake',
+              '--url', 'http://localhost:9000/400/', '--failed', self._path('failed.csv')])
+        # The JSON encoded response body, quoted by csv
+        self.assertEqual(self._read('failed.csv')[0], 'ABC,"""Something was wrong!"""')
+
+    def test_bulk_send_success(self):
+        path = self._write('tokens.txt', u'ABC\nDEF\n')
+        ret = main([path, '--payload', self.payload, '--api-key', 'fake',
+                    '--url', 'http://localhost:9000/echo/'])
+        self.assertEqual(ret, 0)
+
+    def test_worker_errors(self):
+        from simplegcm.__main__ import BulkSender, Report
+
+        def broken_send(tokens):
+            raise RuntimeError('boom')
+
+        bulk = BulkSender(Sender(api_key='fake', url='http://localhost:9000/200/'),
+                          {}, Report(), concurrency=1, batch_size=1)
+        bulk._send = broken_send
+        # More batches than the queue holds, it must not block
+        report = bulk.run(['ABC%d' % i for i in range(10)])
+        self.assertEqual(report.failed, 10)
+
+    def test_warmup_report(self):
+        from simplegcm.__main__ import BulkSender, Report
+
+        def warmup_lines(url, concurrency):
+            with tempfile.TemporaryFile('w+') as out:
+                bulk = BulkSender(Sender(api_key='fake', url=url), {},
+                                  Report(out=out), concurrency=concurrency)
+                bulk.run([])
+                out.seek(0)
+                return out.read().splitlines()
+
+        # The mock server answers 501 to the warm-up HEAD requests
+        lines = warmup_lines('http://localhost:9000/200/', 2)
+        self.assertEqual(lines[0], 'warm-up: unexpected HTTP status 501, check the URL')
+        lines = warmup_lines('http://localhost:1/gcm/send', 1)
+        self.assertTrue(lines[0].startswith('warm-up: connection failed: '))
+
+    def test_bad_arguments(self):
+        bad_payload = self._write('bad.json', u'{"to": "ABC"}')
+        bad_nested = self._write('bad_nested.json', u'{"notification": {"titel": "x"}}')
+        missing = self._path('missing.txt')
+        for argv in ([self.payload, '--payload', self.payload, '--api-key', ''],
+                     ['-', '--payload', bad_payload, '--api-key', 'fake'],
+                     ['-', '--payload', bad_nested, '--api-key', 'fake'],
+                     ['-', '--payload', self.payload, '--api-key', 'fake', '--batch-size', '1001'],
+                     ['-', '--payload', self.payload, '--api-key', 'fake', '--retries', '-1'],
+                     ['-', '--payload', self.payload, '--api-key', 'fake', '--rate', '0'],
+                     ['-', '--payload', missing, '--api-key', 'fake'],
+                     [missing, '--payload', self.payload, '--api-key', 'fake']):
+            self.assertRaises(SystemExit, main, argv)
+
+
+class TraceTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.httpd = MockGCMServer()
+        cls.httpd.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.httpd.shutdown()
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'trace.jsonl.gz')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def _record(self):
+        with trace.TraceRecorder(self.path) as recorder:
+            for path, ids in (('/200/', ['ABC123']),
+                              ('/200_2/', ['oldToken123', 'ABC123', 'CBA123', '123ABC']),
+                              ('/501/', ['ABC123', 'DEF456']),
+                              ('/401/', ['ABC123'])):
+                g = Sender(api_key='fake', url='http://localhost:9000' + path,
+                           recorder=recorder)
+                m = Message(registration_ids=ids, data={'score': 5.0})
+                try:
+                    g.send(m)
+                except GCMException:
+                    pass
+        return list(trace.read_trace(self.path))
+
+    def test_record(self):
+        records = self._record()
+        self.assertEqual([r['status'] for r in records], [200, 200, 501, 401])
+        self.assertEqual([r['tokens'] for r in records], [1, 4, 2, 1])
+        self.assertGreaterEqual(records[0]['t'], 0)
+        self.assertEqual([r['t'] for r in records], sorted(r['t'] for r in records))
+        self.assertEqual(records[2]['retry_after'], '5')
+        self.assertEqual(json.loads(records[1]['body'])['canonical_ids'], 1)
+        for r in records:
+            self.assertGreater(r['size'], 0)
+            self.assertGreater(r['latency'], 0)
+
+    def test_gzip_round_trip(self):
+        class Response(object):
+            status_code = 200
+            headers = {'Retry-After': '5'}
+            text = u'{"results": ["\u00e9"]}'
+
+        with trace.TraceRecorder(self.path) as recorder:
+            recorder.record(10, 1, Response(), 0.01)
+            recorder.record(20, 2, Response(), 0.02)
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(2), b'\x1f\x8b')
+        records = list(trace.read_trace(self.path))
+        self.assertEqual([(r['size'], r['tokens']) for r in records], [(10, 1), (20, 2)])
+        self.assertEqual(records[0]['body'], Response.text)
+        self.assertEqual(records[0]['retry_after'], '5')
+
+    def test_recorder_errors(self):
+        recorder = trace.TraceRecorder(self.path)
+        recorder.close()
+        g = Sender(api_key='fake', url='http://localhost:9000/200/', recorder=recorder)
+        m = Message(registration_ids=['ABC123'], data={'score': 5.0})
+        logging.disable(logging.CRITICAL)
+        try:
+            r = g.send(m)
+        finally:
+            logging.disable(logging.NOTSET)
+        self.assertEqual(len(r.success), 1)
+
+    def test_record_overlapping(self):
+        class Response(object):
+            status_code = 200
+            headers = {}
+            text = u'{}'
+
+        with trace.TraceRecorder(self.path) as recorder:
+            start = time.time()
+            time.sleep(0.2)
+            # B was sent after A but completes first
+            recorder.record(10, 1, Response(), time.time() - start - 0.1)
+            time.sleep(0.1)
+            recorder.record(20, 1, Response(), time.time() - start)
+        records = list(trace.read_trace(self.path))
+        self.assertEqual([r['size'] for r in records], [10, 20])
+        self.assertGreaterEqual(records[1]['t'], 0)
+        self.assertAlmostEqual(records[0]['t'] - records[1]['t'], 0.1, delta=0.05)
+        self.assertGreaterEqual(trace.summarize(records)['elapsed'], 0.3)
+
+    def test_replay(self):
+        records = self._record()
+        for r in records:
+            r['latency'] = 0.05
+        summary = trace.replay(records, concurrency=4, speed=0)
+        self.assertEqual(summary['requests'], 4)
+        self.assertEqual(summary['tokens'], 8)
+        # Only the 401 raises
+        self.assertEqual(summary['errors'], 1)
+        self.assertGreaterEqual(summary['latency_p50'], 0.05)
+        # The recorded latencies are served in parallel
+        self.assertLess(summary['elapsed'], 4 * 0.05)
+
+        changes = trace.compare(summary, dict(summary, latency_p50=summary['latency_p50'] * 2))
+        self.assertAlmostEqual(changes['latency_p50'], 1.0)
+        self.assertEqual(changes['requests'], 0)
+
+    def test_main(self):
+        self._record()
+        output = os.path.join(self.tmp, 'summary.json')
+        self.assertEqual(trace.main(['replay', self.path, '--speed', '0', '--output', output]), 0)
+        with io.open(output, encoding='utf-8') as f:
+            self.assertEqual(json.load(f)['requests'], 4)
+        self.assertEqual(trace.main(['compare', output, output]), 0)
+
+    def test_replay_payload_size(self):
+        record = {'tokens': 3, 'size': 500}
+        m = trace._build_message(0, record)
+        self.assertEqual(len(m._registration_ids), 3)
+        self.assertEqual(len(json.dumps(m.body)), 500)
+
+
+@unittest.skipIf(sys.version_info < (3, 7), 'requires python -X importtime')
+class ImportTestCase(unittest.TestCase):
+    def _importtime(self):
+        """Return the cumulative import time (us) of every imported module."""
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.path.dirname(os.path.dirname(simplegcm.__file__))
+        proc = subprocess.Popen([sys.executable, '-X', 'importtime', '-c', 'import simplegcm'],
+                                env=env, stderr=subprocess.PIPE)
+        _, err = proc.communicate()
+        self.assertEqual(proc.returncode, 0, err)
+        timings = {}
+        for line in err.decode('utf-8').splitlines():
+            if not line.startswith('import time:') or 'cumulative' in line:
+                continue
+            _, cumulative, name = line[len('import time:'):].split('|')
+            timings[name.strip()] = int(cumulative)
+        return timings
+
+    def test_http_stack_not_imported(self):
+        timings = self._importtime()
+        self.assertIn('simplegcm.gcm', timings)
+        for name in ('requests', 'urllib3', 'simplegcm.transport'):
+            self.assertNotIn(name, timings)
+
+    def test_import_time_budget(self):
+        # Best of a few runs to smooth out a noisy machine
+        best = min(self._importtime()['simplegcm'] for _ in range(3))
+        self.assertLess(best, IMPORT_TIME_BUDGET)
+
+    def test_public_api(self):
+        for name in simplegcm.gcm.__all__:
+            self.assertTrue(hasattr(simplegcm, name))
+
+
 if __name__ == '__main__':
     unittest.main()